@@ -1,23 +1,31 @@
 # src/create_knowledge_base.py
-import json
+import orjson
 import chromadb
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
 import os
 import sys
 
 # Add parent directory to path to import from data folder
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+def get_embedding_function():
+    """ONNX MiniLM embedder pinned to the CPU provider, shared with the query side."""
+    return ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+
 def create_knowledge_base():
     # Load your metadata from data folder
     metadata_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'indian_deserts.json')
     
-    with open(metadata_path) as f:
-        metadata = json.load(f)
+    with open(metadata_path, 'rb') as f:
+        metadata = orjson.loads(f.read())
     
     # Initialize ChromaDB - store in project root
     chroma_path = os.path.join(os.path.dirname(__file__), '..', 'chroma_db')
     client = chromadb.PersistentClient(path=chroma_path)
+    # The collection keeps Chroma's default embedder config (the same MiniLM
+    # model); vectors are computed with the pinned embedder and passed in
     collection = client.get_or_create_collection(name="schema_knowledge_base")
+    embedding_function = get_embedding_function()
     
     documents = []
     metadatas = []
@@ -65,11 +73,13 @@ def create_knowledge_base():
     })
     ids.append("indian_desserts_table")
     
-    # Add to collection
+    # Embed every document in one batched forward pass, then add to collection
+    embeddings = embedding_function(documents)
     collection.add(
         documents=documents,
         metadatas=metadatas,
-        ids=ids
+        ids=ids,
+        embeddings=embeddings
     )
     
     print("✅ Knowledge base created successfully!")
@@ -1,14 +1,30 @@
 # src/enhanced_flow.py
 from langgraph.graph import StateGraph, START, END
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_community.cache import SQLiteCache
+from langchain_core.globals import set_llm_cache
 from typing import TypedDict, Literal
+from pydantic import BaseModel, Field
 import sqlite3
-import json
+import orjson
 import os
 import re
 import sys
+import atexit
+import threading
+from functools import lru_cache
+from pathlib import Path
 from dotenv import load_dotenv
 import chromadb
+import numpy as np
+from numba import njit
+import sqlglot
+from sqlglot import exp
+try:
+    from .create_knowledge_base import get_embedding_function
+except ImportError:
+    # Run as a script (python src/enhanced_flow.py): src/ is sys.path[0]
+    from create_knowledge_base import get_embedding_function
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -16,11 +32,78 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Load environment variables
 load_dotenv()
 
+# Persistent LLM response cache: a repeated prompt skips the Gemini round-trip
+set_llm_cache(SQLiteCache(
+    database_path=os.path.join(os.path.dirname(__file__), '..', '.llm_cache.db')
+))
+
 model = ChatGoogleGenerativeAI(
     model='gemini-2.5-flash',
     google_api_key=os.getenv('GEMINI_API_KEY')
 )
 
+# Database path in data folder
+DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'desserts.db')
+
+# One read-only connection per thread, reused across graph invocations so
+# SQLite's page cache stays warm instead of being rebuilt on every query.
+# Read-only also means generated DML can never modify the tracked database
+_DB_URI = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+_local = threading.local()
+_connections = []
+
+def get_connection():
+    """Return this thread's shared read-only connection to desserts.db."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(_DB_URI, uri=True, check_same_thread=False)
+        _local.conn = conn
+        _connections.append(conn)
+    return conn
+
+@atexit.register
+def _close_connections():
+    for conn in _connections:
+        conn.close()
+
+# Schema metadata from data folder, loaded once at import
+METADATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'indian_deserts.json')
+with open(METADATA_PATH, 'rb') as f:
+    _METADATA = orjson.loads(f.read())
+_VALID_COLS = frozenset(_METADATA["indian_desserts"]["columns"])
+
+def format_schema(columns: dict) -> str:
+    """Render columns as the bullet list used in the generate_sql prompt."""
+    return "\n".join(
+        f"- {col_name} ({col_info['type']}): {col_info.get('description', '')}"
+        for col_name, col_info in columns.items()
+    )
+
+# Full-schema prompt text, used when retrieval falls back to every column
+_SCHEMA_TEXT = format_schema(_METADATA["indian_desserts"]["columns"])
+
+# Fallback cleaning for free-text replies: opening fence, closing fence and
+# a leading "sql"/"sqlite" word, all matched in a single scan
+_CLEAN_RE = re.compile(
+    r'^\s*```(?:sqlite|sql)?\s*|\s*```\s*$|^\s*(?:sqlite|sql)\b\s*',
+    re.IGNORECASE
+)
+
+def clean_sql(text: str) -> str:
+    """Strip markdown fences, sql/sqlite prefixes and trailing semicolons from LLM output."""
+    sql_query = text.strip()
+    while True:
+        cleaned = _CLEAN_RE.sub('', sql_query)
+        if cleaned == sql_query:
+            break
+        sql_query = cleaned
+    return sql_query.rstrip('; \n\t')
+
+# Fallback column extraction when sqlglot cannot parse the query
+_SELECT_RE = re.compile(r'SELECT\s+(.*?)\s+FROM', re.IGNORECASE | re.DOTALL)
+_ALIAS_RE = re.compile(r'\s+AS\s+\w+$', re.IGNORECASE)
+_IDENT_RE = re.compile(r'^\w+$')
+
 class AgentState(TypedDict):
     user_query: str
     sql_query: str
@@ -31,6 +114,14 @@ class AgentState(TypedDict):
     query_keywords: list
     relevant_schema: dict
     business_domains: list
+    seen: dict
+
+class SQLQuery(BaseModel):
+    sql: str = Field(
+        description="Raw SQLite query with no markdown, explanation or trailing semicolon."
+    )
+
+sql_model = model.with_structured_output(SQLQuery)
 
 def get_user_query(_: AgentState) -> AgentState:
     user_query = input("Enter your question: ")
@@ -43,7 +134,8 @@ def get_user_query(_: AgentState) -> AgentState:
         "iteration_count": 0,
         "query_keywords": [],
         "relevant_schema": {},
-        "business_domains": []
+        "business_domains": [],
+        "seen": {}
     }
 
 def analyze_query_intent(state: AgentState) -> AgentState:
@@ -66,15 +158,13 @@ def analyze_query_intent(state: AgentState) -> AgentState:
     
     try:
         response = model.invoke(prompt)
-        import json as json_lib
-        result = json_lib.loads(response.content.strip())
+        result = orjson.loads(response.content.strip())
         
         print(f"🔍 Query Analysis:")
         print(f"   Keywords: {result['keywords']}")
         print(f"   Domains: {result['domains']}")
         
         return {
-            **state,
             "query_keywords": result['keywords'],
             "business_domains": result['domains']
         }
@@ -82,30 +172,68 @@ def analyze_query_intent(state: AgentState) -> AgentState:
         print(f"❌ Error in query analysis: {e}")
         simple_keywords = state['user_query'].lower().split()
         return {
-            **state,
             "query_keywords": simple_keywords,
             "business_domains": ["Food", "Desserts"]
         }
 
+@lru_cache(maxsize=None)
+def load_schema_index():
+    """Load the knowledge base once into RAM: unit-norm embeddings, documents, metadatas, embedder."""
+    # ChromaDB path relative to project root
+    chroma_path = os.path.join(os.path.dirname(__file__), '..', 'chroma_db')
+    client = chromadb.PersistentClient(path=chroma_path)
+    # Opened without an embedding function so it matches the persisted
+    # "default" config; the pinned embedder is only used for query vectors
+    collection = client.get_collection("schema_knowledge_base")
+    embed = get_embedding_function()
+    data = collection.get(include=['embeddings', 'metadatas', 'documents'])
+
+    embeddings = np.asarray(data['embeddings'], dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, data['documents'], data['metadatas'], embed
+
+# Below this many schema documents a plain NumPy matvec is cheaper than
+# calling into the JIT kernel
+_JIT_MIN_ROWS = 1024
+
+# Serial on purpose: a parallel kernel gains nothing at this size and numba's
+# default threading layer aborts if LangGraph worker threads enter it at once
+@njit(fastmath=True, cache=True)
+def cosine_scores(embeddings, query):
+    """Cosine similarity of each unit-norm row of embeddings with the unit-norm query."""
+    n, dim = embeddings.shape
+    scores = np.empty(n, dtype=np.float32)
+    for i in range(n):
+        acc = np.float32(0.0)
+        for j in range(dim):
+            acc += embeddings[i, j] * query[j]
+        scores[i] = acc
+    return scores
+
 def retrieve_relevant_schema(state: AgentState) -> AgentState:
     try:
-        # ChromaDB path relative to project root
-        chroma_path = os.path.join(os.path.dirname(__file__), '..', 'chroma_db')
-        client = chromadb.PersistentClient(path=chroma_path)
-        collection = client.get_collection("schema_knowledge_base")
+        embeddings, documents, metadatas, embed = load_schema_index()
         
-        search_terms = " ".join(state['query_keywords'] + state['business_domains'])
+        # Runs in parallel with analyze_query_intent, so search on the raw question
+        search_terms = state['user_query']
         
-        results = collection.query(
-            query_texts=[search_terms],
-            n_results=5
-        )
+        # Cosine similarity over the schema documents held in memory
+        query = np.asarray(embed([search_terms])[0], dtype=np.float32)
+        query /= np.linalg.norm(query)
+        if len(embeddings) >= _JIT_MIN_ROWS:
+            scores = cosine_scores(embeddings, query)
+        else:
+            scores = embeddings @ query
+        k = min(5, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
         
         relevant_columns = {}
         table_info = {}
         
-        for i, doc in enumerate(results['documents'][0]):
-            metadata = results['metadatas'][0][i]
+        for i in top:
+            doc = documents[i]
+            metadata = metadatas[i]
             
             if metadata['column'] == 'all':
                 table_info = {
@@ -123,7 +251,8 @@ def retrieve_relevant_schema(state: AgentState) -> AgentState:
         relevant_schema = {
             'tables': ['indian_desserts'],
             'columns': relevant_columns,
-            'table_info': table_info
+            'table_info': table_info,
+            'schema_text': format_schema(relevant_columns)
         }
         
         print(f"📚 Retrieved Relevant Schema:")
@@ -131,35 +260,27 @@ def retrieve_relevant_schema(state: AgentState) -> AgentState:
         print(f"   Columns: {list(relevant_columns.keys())}")
         
         return {
-            **state,
             "relevant_schema": relevant_schema
         }
         
     except Exception as e:
         print(f"❌ Error retrieving schema: {e}")
-        # Fallback to full schema from data folder
-        metadata_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'indian_deserts.json')
-        with open(metadata_path) as f:
-            full_metadata = json.load(f)
+        # Fallback to full schema
         return {
-            **state,
             "relevant_schema": {
                 'tables': ['indian_desserts'],
-                'columns': full_metadata['indian_desserts']['columns'],
-                'table_info': {'description': 'Fallback: full schema loaded'}
+                'columns': _METADATA['indian_desserts']['columns'],
+                'table_info': {'description': 'Fallback: full schema loaded'},
+                'schema_text': _SCHEMA_TEXT
             }
         }
 
 def generate_sql(state: AgentState):
-    schema_desc = []
-    for col_name, col_info in state['relevant_schema']['columns'].items():
-        schema_desc.append(
-            f"- {col_name} ({col_info['type']}): {col_info.get('description', '')}"
-        )
-    schema_text = "\n".join(schema_desc)
-    
+    schema_text = state['relevant_schema']['schema_text']
+
     retrieval_context = f"""
     Based on your query about: {', '.join(state['query_keywords'])}
+    Business domains involved: {', '.join(state['business_domains'])}
     I've retrieved these relevant columns: {', '.join(state['relevant_schema']['columns'].keys())}
     """
 
@@ -185,53 +306,97 @@ def generate_sql(state: AgentState):
     - Use ONLY the columns I provided above
     """
 
-    response = model.invoke(prompt)
-    
-    sql_query = response.content.strip()
-    sql_query = re.sub(r'^```sql\s*', '', sql_query, flags=re.IGNORECASE)
-    sql_query = re.sub(r'^```\s*', '', sql_query)
-    sql_query = re.sub(r'```$', '', sql_query)
-    sql_query = re.sub(r'^\s*sql\s*', '', sql_query, flags=re.IGNORECASE)
-    sql_query = re.sub(r'^\s*sqlite\s*', '', sql_query, flags=re.IGNORECASE)
-    sql_query = sql_query.rstrip('; \n\t')
+    response = sql_model.invoke(prompt)
+    if response is not None:
+        sql_query = response.sql.strip().rstrip('; \n\t')
+    else:
+        # Gemini answered without the structured tool call; clean its free text
+        sql_query = clean_sql(model.invoke(prompt).content)
 
     print(f"\n🧠 Generated SQL (Iteration {state['iteration_count']}): {sql_query}")
     
     return {
-        **state, 
         "sql_query": sql_query,
         "iteration_count": state["iteration_count"] + 1
     }
 
+def parse_sql(sql_query: str):
+    """Parse a query with sqlglot's SQLite dialect, or return None if it cannot."""
+    try:
+        return sqlglot.parse_one(sql_query, read='sqlite')
+    except sqlglot.errors.SqlglotError:
+        return None
+
+def extract_columns(sql_query: str, parsed=None) -> set:
+    """Return the lower-cased column names referenced by a query, with * for SELECT *.
+
+    parsed is the sqlglot tree from parse_sql; when it is None the SELECT list
+    is scanned with a regex instead.
+    """
+    if parsed is not None:
+        aliases = {a.alias.lower() for a in parsed.find_all(exp.Alias)}
+        columns = set()
+        for column in parsed.find_all(exp.Column):
+            name = column.name.lower()
+            # Like SQLite, treat a double-quoted name that matches no column
+            # as a string literal ("dessert"), not an invalid column
+            quoted = isinstance(column.this, exp.Identifier) and column.this.quoted
+            if quoted and name not in _VALID_COLS:
+                continue
+            columns.add(name)
+        columns -= aliases
+        select = parsed.find(exp.Select)
+        if select and any(isinstance(e, exp.Star) for e in select.expressions):
+            columns.add("*")
+        return columns
+
+    match = _SELECT_RE.search(sql_query)
+    if not match:
+        return set()
+    columns = set()
+    for item in match.group(1).split(","):
+        item = _ALIAS_RE.sub('', item.strip()).lower()
+        if item == "*" or _IDENT_RE.match(item):
+            columns.add(item)
+    return columns
+
 def validate_sql(state: AgentState) -> AgentState:
     sql_query = state["sql_query"]
     validation_passed = True
     feedback = ""
 
-    # Load full schema for validation from data folder
-    metadata_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'indian_deserts.json')
-    with open(metadata_path) as f:
-        full_metadata = json.load(f)
-    valid_columns = set(full_metadata["indian_desserts"]["columns"].keys())
-
-    prompt = f"""
-    Extract ONLY the column names from this SQL query:
-    ---
-    {sql_query}
-    ---
-    Rules:
-    - Include columns from SELECT and WHERE clauses.
-    - Ignore SQL keywords, table names, and string literals.
-    - For SELECT *, return *.
-    - Output comma-separated column names only.
-    """
-
-    try:
-        response = model.invoke(prompt)
-        extracted_cols_list = [
-            c.strip().lower() for c in response.content.split(",") if c.strip()
-        ]
-        extracted_columns = set(extracted_cols_list)
+    # seen maps each generated query to (verdict, feedback, times generated);
+    # verdict is "rejected" when SQLite itself refused the query
+    seen = state.get("seen", {})
+    if sql_query in seen:
+        verdict, feedback, hits = seen[sql_query]
+        print(f"\n🧾 Validation Feedback (repeated query): {feedback}")
+        update = {
+            "validation_passed": "passed" if verdict == "passed" else "failed",
+            "feedback": feedback,
+            "seen": {**seen, sql_query: (verdict, feedback, hits + 1)},
+        }
+        if verdict == "rejected":
+            # The run ends here, so report this query's own error rather
+            # than whatever the previous attempt left in result
+            update["result"] = feedback
+        return update
+
+    valid_columns = _VALID_COLS
+
+    # Syntax errors are caught when execute_sql runs the query, so there is
+    # no separate dry-run here
+    parsed = parse_sql(sql_query)
+    if parsed is not None:
+        read_only = isinstance(parsed, exp.Query)
+    else:
+        read_only = sql_query.lstrip().upper().startswith(("SELECT", "WITH"))
+
+    if not read_only:
+        validation_passed = False
+        feedback = "Only SELECT queries are allowed; do not modify the database."
+    else:
+        extracted_columns = extract_columns(sql_query, parsed)
 
         if "*" in extracted_columns:
             feedback = "Query uses SELECT *, which is acceptable."
@@ -246,39 +411,62 @@ def validate_sql(state: AgentState) -> AgentState:
             else:
                 feedback = "All columns are valid."
 
-    except Exception as e:
-        validation_passed = False
-        feedback = f"Validation error: {str(e)}"
-
     print(f"\n🧾 Validation Feedback: {feedback}")
 
+    verdict = "passed" if validation_passed else "failed"
     return {
-        **state,
-        "validation_passed": "passed" if validation_passed else "failed",
+        "validation_passed": verdict,
         "feedback": feedback,
+        "seen": {**seen, sql_query: (verdict, feedback, 1)},
     }
 
 def execute_sql(state: AgentState):
-    # Database path in data folder
-    db_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'desserts.db')
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    sql_query = state["sql_query"]
+    cursor = get_connection().cursor()
     try:
-        cursor.execute(state["sql_query"])
+        # SQLite resolves syntax and columns when preparing the statement, so
+        # the real run doubles as the final validation
+        cursor.execute(sql_query)
         rows = cursor.fetchall()
-        result = rows if rows else "No results found."
-        print("📊 Query Result:", result)
-    except Exception as e:
+    except (sqlite3.Error, sqlite3.Warning) as e:
+        # sqlite3.Warning (e.g. several statements in one reply on Python
+        # 3.10) is not a subclass of sqlite3.Error
+        feedback = f"SQL error: {e}"
         result = f"Execution Error: {e}"
         print(result)
+        seen = state.get("seen", {})
+        _, _, hits = seen.get(sql_query, ("rejected", feedback, 1))
+        return {
+            "validation_passed": "failed",
+            "feedback": feedback,
+            "result": result,
+            "seen": {**seen, sql_query: ("rejected", feedback, hits)},
+        }
     finally:
-        conn.close()
+        cursor.close()
 
-    return {**state, "result": str(result)}
+    result = rows if rows else "No results found."
+    print("📊 Query Result:", result)
+    return {"result": str(result)}
 
 def validation_check(state: AgentState):
-    return "execute_sql" if state["validation_passed"] == "passed" else "generate_sql"
+    # The same failing query coming back means the feedback is not changing
+    # the model's answer, so stop looping and run it as is, unless SQLite
+    # already rejected it, in which case re-running it is pointless
+    verdict, _, hits = state["seen"][state["sql_query"]]
+    if verdict == "rejected":
+        return END
+    if state["validation_passed"] == "passed" or hits > 1:
+        return "execute_sql"
+    return "generate_sql"
+
+def execution_check(state: AgentState):
+    # A query SQLite rejected goes back for regeneration with the error as
+    # feedback, unless the model has already produced it more than once
+    _, _, hits = state["seen"][state["sql_query"]]
+    if state["validation_passed"] == "failed" and hits == 1:
+        return "generate_sql"
+    return END
 
 # Build the graph
 graph = StateGraph(AgentState)
@@ -291,9 +479,11 @@ graph.add_node("validate_sql", validate_sql)
 graph.add_node("execute_sql", execute_sql)
 
 graph.add_edge(START, "get_user_query")
+# Intent analysis (LLM) and schema retrieval run in parallel; generate_sql
+# waits for both branches
 graph.add_edge("get_user_query", "analyze_query_intent")
-graph.add_edge("analyze_query_intent", "retrieve_relevant_schema")
-graph.add_edge("retrieve_relevant_schema", "generate_sql")
+graph.add_edge("get_user_query", "retrieve_relevant_schema")
+graph.add_edge(["analyze_query_intent", "retrieve_relevant_schema"], "generate_sql")
 graph.add_edge("generate_sql", "validate_sql")
 
 graph.add_conditional_edges(
@@ -301,23 +491,30 @@ graph.add_conditional_edges(
     validation_check,
     {
         "execute_sql": "execute_sql",
-        "generate_sql": "generate_sql"
+        "generate_sql": "generate_sql",
+        END: END
     }
 )
 
-graph.add_edge("execute_sql", END)
+graph.add_conditional_edges(
+    "execute_sql",
+    execution_check,
+    {
+        "generate_sql": "generate_sql",
+        END: END
+    }
+)
 
 workflow = graph.compile()
 
 if __name__ == "__main__":
     # Check if knowledge base exists
     try:
-        chroma_path = os.path.join(os.path.dirname(__file__), '..', 'chroma_db')
-        client = chromadb.PersistentClient(path=chroma_path)
-        client.get_collection("schema_knowledge_base")
+        load_schema_index()
         print("✅ Knowledge base loaded")
-    except:
-        print("❌ Knowledge base not found. Please run create_knowledge_base.py first")
+    except Exception as e:
+        print(f"❌ Could not load knowledge base: {e}")
+        print("   If it is missing, run create_knowledge_base.py first")
         exit(1)
     
     print("🍰 Welcome to the Enhanced Indian Desserts SQL Agent!")
@@ -331,7 +528,8 @@ if __name__ == "__main__":
         "iteration_count": 0,
         "query_keywords": [],
         "relevant_schema": {},
-        "business_domains": []
+        "business_domains": [],
+        "seen": {}
     }
 
     result = workflow.invoke(initial_state)
@@ -1,27 +1,55 @@
 from langgraph.graph import StateGraph, START, END
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_community.cache import SQLiteCache
+from langchain_core.globals import set_llm_cache
 import sqlite3
 import pandas as pd
 import os
+import re
+from contextlib import closing
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import TypedDict,Literal
 from pydantic import BaseModel,Field
  
 load_dotenv()
+# Persistent LLM response cache: a repeated prompt skips the Gemini round-trip
+set_llm_cache(SQLiteCache(
+    database_path=os.path.join(os.path.dirname(__file__), '..', '.llm_cache.db')
+))
 model = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash",
     google_api_key=os.getenv("GEMINI_API_KEY")
 )
 DB_PATH = "hr_analytics.sqlite"
  
+# Fallback cleaning for free-text replies: opening fence, closing fence and
+# a leading "sql"/"sqlite" word, all matched in a single scan
+_CLEAN_RE = re.compile(
+    r'^\s*```(?:sqlite|sql)?\s*|\s*```\s*$|^\s*(?:sqlite|sql)\b\s*',
+    re.IGNORECASE
+)
+ 
+def clean_sql(text: str) -> str:
+    """Strip markdown fences, sql/sqlite prefixes and trailing semicolons from LLM output."""
+    sql_query = text.strip()
+    while True:
+        cleaned = _CLEAN_RE.sub('', sql_query)
+        if cleaned == sql_query:
+            break
+        sql_query = cleaned
+    return sql_query.rstrip('; \n\t')
+ 
 def get_connection():
     """Return a connection to the local SQLite DB."""
     return sqlite3.connect(DB_PATH)
  
-def get_table_schema(conn, table_name="employees"):
-    """Return list of tuples: (column_name, data_type)"""
-    cursor = conn.execute(f"PRAGMA table_info({table_name});")
-    return [(row[1], row[2]) for row in cursor.fetchall()]
+@lru_cache(maxsize=None)
+def get_table_schema(table_name="employees"):
+    """Return tuple of tuples: (column_name, data_type). Cached, the schema is fixed."""
+    with closing(get_connection()) as conn:
+        cursor = conn.execute(f"PRAGMA table_info({table_name});")
+        return tuple((row[1], row[2]) for row in cursor.fetchall())
  
  
 class SQLState(TypedDict):
@@ -38,14 +66,19 @@ class validationSchema(BaseModel):
  
 structuredModel1=model.with_structured_output(validationSchema)
  
+class sqlSchema(BaseModel):
+    sql: str = Field(
+        description="Raw SQL query with no markdown, explanation or trailing semicolon."
+    )
+ 
+structuredModel2=model.with_structured_output(sqlSchema)
+ 
 def get_user_Query(state: SQLState):
     cleaned_query = state["user_query"].strip().lower()
     return {"user_query": cleaned_query}
  
 def generate_sql_query(state: SQLState):
-    conn = get_connection()
-    schema_info = get_table_schema(conn, "employees")
-    conn.close()
+    schema_info = get_table_schema("employees")
  
     """
     Generate SQL query from user natural language input using Gemini.
@@ -66,23 +99,14 @@ def generate_sql_query(state: SQLState):
     Only return SQL, no explanation.
     """
  
-    response = model.invoke(prompt)
-   
-    # ROBUST CLEANING
-    import re
-    sql_query = response.content.strip()  # remove leading/trailing whitespace
-   
-    # Remove markdown code blocks
-    sql_query = re.sub(r'^```sql\s*', '', sql_query, flags=re.IGNORECASE)
-    sql_query = re.sub(r'^```\s*', '', sql_query)
-    sql_query = re.sub(r'```$', '', sql_query)
-   
-    # Remove common prefixes
-    sql_query = re.sub(r'^\s*sql\s*', '', sql_query, flags=re.IGNORECASE)
-    sql_query = re.sub(r'^\s*sqlite\s*', '', sql_query, flags=re.IGNORECASE)
-   
-    # Remove trailing semicolon
-    sql_query = sql_query.rstrip('; \n\t')
+    # Structured output returns the bare SQL, so only a trailing semicolon
+    # needs removing
+    response = structuredModel2.invoke(prompt)
+    if response is not None:
+        sql_query = response.sql.strip().rstrip('; \n\t')
+    else:
+        # Gemini answered without the structured tool call; clean its free text
+        sql_query = clean_sql(model.invoke(prompt).content)
    
     return {"sql_query": sql_query}
  